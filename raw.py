@@ -4,6 +4,8 @@ import sys
 import os
 import time
 import struct
+import mmap
+import select
 import argparse
 import serial
 import binascii
@@ -19,25 +21,44 @@ OTA_CMD_VERIFY = 0x04
 
 CHUNK_SIZE = 4096  # 4KB 每块
 DEFAULT_BAUD = 2000000 
+SERIAL_BUFFER_SIZE = 256 * 1024  # 驱动收发缓冲, 容纳多个在途帧
+
+# 帧头 [HEADER:2][CMD:1][LEN:2][RESERVED:9] 与 CRC 的预编译格式
+_FRAME_HEAD = struct.Struct('>HBH9x')
+_CRC_U16 = struct.Struct('>H')
+# ACK 帧前缀 [HEADER:2][STATUS:1][MSG_LEN:1]
+_ACK_PREFIX = struct.Struct('>2sBB')
 
 # ===================== 工具函数 =====================
-def crc16_xmodem(data):
-    """计算CRC16-XMODEM"""
-    crc = 0
-    for byte in data:
-        crc ^= byte << 8
-        for _ in range(8):
-            crc <<= 1
-            if crc & 0x10000:
-                crc ^= 0x1021
-    return crc & 0xFFFF
+def crc16_xmodem(data, crc=0):
+    """计算CRC16-XMODEM
+
+    binascii.crc_hqx 即 CRC-CCITT (多项式 0x1021, 非反射), 初值为 0 时
+    与 XMODEM 完全一致, 且在 C 层逐字节计算。
+    传入上一段的 crc 可分段增量计算。
+    """
+    return binascii.crc_hqx(data, crc)
+
+def positive_int(value):
+    """argparse 类型: 正整数"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须为正整数: {value}")
+    return number
 
 # ===================== OTA 类 =====================
 class ESP32OTA:
-    def __init__(self, port, baudrate):
+    def __init__(self, port, baudrate, window=1):
         self.port = port
         self.baudrate = baudrate
+        if window < 1:
+            raise ValueError(f"window 必须为正整数: {window}")
+        self.window = window  # 同时在途(未确认)的 DATA 帧数
         self.ser = None
+        self._rx_buffer = bytearray()  # 跨调用保留, 流水线发送时一次可能收到多个 ACK
+        self._tx_buffer = bytearray(_FRAME_HEAD.size + CHUNK_SIZE + _CRC_U16.size)  # 复用的发送帧缓冲
+        self._tx_head = None   # 发送缓冲中已填好的帧头 (cmd, len)
+        self._tx_head_crc = 0  # 该帧头的 CRC, 作为负载 CRC 的初值
 
     def connect(self):
         print(f"[*] 正在连接串口 {self.port} @ {self.baudrate}...")
@@ -53,6 +74,7 @@ class ESP32OTA:
                 rtscts=False,
                 dsrdtr=False
             )
+            self._tune_port()
             
             # 复位设备
             self._reset_device()
@@ -61,6 +83,24 @@ class ESP32OTA:
             print(f"[-] 连接失败: {e}")
             return False
 
+    def _tune_port(self):
+        """调整串口驱动缓冲与接收延迟 (尽力而为, 驱动不支持时忽略)"""
+        # Windows: SetupComm 加大驱动缓冲, 默认值在流水线发送时容易溢出
+        if hasattr(self.ser, 'set_buffer_size'):
+            try:
+                self.ser.set_buffer_size(rx_size=SERIAL_BUFFER_SIZE, tx_size=SERIAL_BUFFER_SIZE)
+            except Exception:
+                pass  # 驱动不支持, 使用默认缓冲
+            return
+
+        # Linux: 设置 ASYNC_LOW_LATENCY, 关闭驱动默认的接收合并延迟
+        # (pyserial 在其他 POSIX 平台上也有此方法, 但会抛出 NotImplementedError)
+        if sys.platform.startswith('linux') and hasattr(self.ser, 'set_low_latency_mode'):
+            try:
+                self.ser.set_low_latency_mode(True)
+            except (ValueError, NotImplementedError):
+                pass  # 驱动不支持
+
     def close(self):
         if self.ser and self.ser.is_open:
             self.ser.close()
@@ -85,47 +125,60 @@ class ESP32OTA:
         
         # 清空启动日志
         self.ser.reset_input_buffer()
+        self._rx_buffer.clear()
         print("[*] 准备就绪")
 
-    def send_frame(self, cmd, payload=b''):
-        """发送协议帧"""
+    def send_frame(self, cmd, payload=b'', flush=False):
+        """发送协议帧
+
+        flush=True 时等待发送缓冲区排空; DATA 帧无需等待, 交给系统缓冲。
+        """
         if self.ser is None:
             return
             
         # 构造帧: [HEADER:2][CMD:1][LEN:2][RESERVED:9][DATA:N][CRC:2]
-        header = struct.pack('>H', OTA_FRAME_HEADER)
-        cmd_byte = struct.pack('B', cmd)
-        length = struct.pack('>H', len(payload))
-        reserved = b'\x00' * 9  # 9字节保留位
-        
-        frame_head = header + cmd_byte + length + reserved
-        # 在计算CRC时，需要把 payload 也包含进去
-        # 固件端计算CRC: crc16_xmodem(frame_buffer, frame_len - 2)
-        # 也就是包含 Header + Cmd + Len + Reserved + Data
+        # 在复用的发送缓冲中就地填充帧头/负载/CRC, 省去三者的拼接
+        # (pyserial 的 write 内部仍会把整帧复制为 bytes)
+        body_len = _FRAME_HEAD.size + len(payload)
+        frame_len = body_len + _CRC_U16.size
+        if len(self._tx_buffer) < frame_len:
+            self._tx_buffer = bytearray(frame_len)
+            self._tx_head = None
+        buf = self._tx_buffer
         
-        data_to_sign = frame_head + payload
-        crc = crc16_xmodem(data_to_sign)
+        # 帧头只随 cmd/长度变化: 连续的整块 DATA 帧复用已填好的帧头及其 CRC
+        head = (cmd, len(payload))
+        if head != self._tx_head:
+            # 9字节保留位由格式中的 9x 填 0
+            _FRAME_HEAD.pack_into(buf, 0, OTA_FRAME_HEADER, cmd, len(payload))
+            self._tx_head = head
+            self._tx_head_crc = crc16_xmodem(buf[:_FRAME_HEAD.size])
+        buf[_FRAME_HEAD.size:body_len] = payload
         
-        final_frame = data_to_sign + struct.pack('>H', crc)
-        
-        # Debug: 打印发送的十六进制
-        # print(f"DEBUG SEND: {binascii.hexlify(final_frame)}")
-        
-        self.ser.write(final_frame)
-        self.ser.flush()
+        with memoryview(buf) as view:
+            # 在计算CRC时，需要把 payload 也包含进去
+            # 固件端计算CRC: crc16_xmodem(frame_buffer, frame_len - 2)
+            # 也就是包含 Header + Cmd + Len + Reserved + Data
+            crc = crc16_xmodem(view[_FRAME_HEAD.size:body_len], self._tx_head_crc)
+            _CRC_U16.pack_into(buf, body_len, crc)
+            
+            # Debug: 打印发送的十六进制
+            # print(f"DEBUG SEND: {binascii.hexlify(view[:frame_len])}")
+            
+            self.ser.write(view[:frame_len])
+        if flush:
+            self.ser.flush()
 
     def receive_ack(self, timeout=2.0, verbose=False):
         """接收ACK"""
         if self.ser is None:
             return -1, "Serial not connected"
 
-        start_time = time.time()
-        buffer = b''
+        monotonic = time.monotonic  # 不受系统时间调整影响
+        start_time = monotonic()
+        buffer = self._rx_buffer
         
-        while (time.time() - start_time) < timeout:
-            if self.ser.in_waiting:
-                buffer += self.ser.read(self.ser.in_waiting)
-            
+        while (monotonic() - start_time) < timeout:
             # 扫描缓冲区寻找帧头 AA 55
             header_idx = buffer.find(OTA_ACK_HEADER_SEQ)
             
@@ -133,14 +186,14 @@ class ESP32OTA:
                 # 丢弃帧头前面的垃圾数据
                 if header_idx > 0:
                     if verbose: 
-                        print(f"丢弃垃圾数据: {buffer[:header_idx]}")
-                    buffer = buffer[header_idx:]
+                        print(f"丢弃垃圾数据: {bytes(buffer[:header_idx])}")
+                    # bytearray 从头部删除只移动起始偏移, 不重新分配
+                    del buffer[:header_idx]
                 
                 # 现在的 buffer 以 AA 55 开头
                 # 需要至少 4 字节才能知道 msg 的长度 (Header(2) + Status(1) + MsgLen(1))
-                if len(buffer) >= 4:
-                    status = buffer[2]
-                    msg_len = buffer[3]
+                if len(buffer) >= _ACK_PREFIX.size:
+                    _, status, msg_len = _ACK_PREFIX.unpack_from(buffer, 0)
                     
                     # 完整帧长度 = Header(2) + Status(1) + MsgLen(1) + Msg(N) + CRC(2)
                     total_len = 2 + 1 + 1 + msg_len + 2
@@ -151,20 +204,23 @@ class ESP32OTA:
                         # 校验 CRC
                         # 校验范围: Header + Status + MsgLen + Msg
                         data_to_check = frame[:-2]
-                        crc_recv = struct.unpack('>H', frame[-2:])[0]
+                        crc_recv, = _CRC_U16.unpack_from(frame, total_len - 2)
                         crc_calc = crc16_xmodem(data_to_check)
                         
                         if crc_recv == crc_calc:
                             msg_data = frame[4:4+msg_len]
                             msg = msg_data.decode('utf-8', errors='replace')
+                            # 保留后续字节 (可能是下一个 ACK)
+                            del buffer[:total_len]
                             return status, msg
                         else:
                             print(f"[-] CRC错误: 收到 {crc_recv:04X} 计算 {crc_calc:04X}")
                             # 移除这个坏帧头，继续搜后面的
-                            buffer = buffer[2:]
+                            del buffer[:2]
                             continue
             
-            time.sleep(0.001)  # 降低延迟，提高吞吐量
+            # 缓冲区中没有完整帧时再读串口, 等待数据到达, 不再忙等轮询
+            buffer.extend(self._read_available(timeout - (monotonic() - start_time)))
             
         # 超时
         if buffer and verbose and timeout > 0.5:
@@ -174,15 +230,36 @@ class ESP32OTA:
             except:
                 print(f"[Device Hex]: {binascii.hexlify(buffer)}")
                 
+        buffer.clear()
         return -1, "Timeout"
 
+    def _read_available(self, timeout):
+        """读取已到达的串口数据, 无数据时最多等待 timeout 秒"""
+        if os.name != 'posix':
+            # Windows: pyserial 使用重叠 I/O, 阻塞到首字节到达或串口超时 (0.05s)
+            return self.ser.read(max(1, self.ser.in_waiting))
+
+        # POSIX: 由内核在数据就绪时唤醒, 免去每轮 TIOCINQ 查询
+        fd = self.ser.fileno()
+        ready, _, _ = select.select([fd], [], [], max(0, timeout))
+        if not ready:
+            return b''
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return b''
+        if not data:
+            # 与 pyserial 一致: 可读却读不到数据说明设备已断开
+            raise serial.SerialException('device reports readiness to read but returned no data')
+        return data
+
     def sync(self):
         """尝试同步（使用VERIFY命令 Ping 设备）"""
         print("[*] 尝试连接设备 (Sync)...")
         
         # 尝试3次
         for i in range(3):
-            self.send_frame(OTA_CMD_VERIFY)
+            self.send_frame(OTA_CMD_VERIFY, flush=True)
             status, msg = self.receive_ack(timeout=1.0, verbose=True)
             
             if status == 0:
@@ -207,13 +284,25 @@ class ESP32OTA:
         print(f"[+] 固件大小: {file_size} Bytes")
         
         with open(file_path, 'rb') as f:
-            data = f.read()
-            
+            if file_size == 0:
+                # 空文件无法映射
+                return self._upload_data(b'', file_size)
+            # 只读映射文件, 不预先读入整个固件
+            # 数据块用 mm[a:b] 取出 (4KB 的 bytes 副本), 不持有映射的导出视图,
+            # 发送中途抛出异常时映射仍可正常关闭
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # 按需分页读入; 提示内核顺序预读, 磁盘读取与串口发送重叠
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                return self._upload_data(mm, file_size)
+
+    def _upload_data(self, data, file_size):
+        """按 START -> DATA -> END 流程发送固件数据"""
         # 1. 发送 START
         print("[*] 发送 START 命令...")
         # START 负载是4字节的大端大小
         start_payload = struct.pack('>I', file_size)
-        self.send_frame(OTA_CMD_START, start_payload)
+        self.send_frame(OTA_CMD_START, start_payload, flush=True)
         
         # 擦除 Flash 可能需要较长时间，给 5-10 秒
         status, msg = self.receive_ack(timeout=10.0, verbose=True)
@@ -224,37 +313,47 @@ class ESP32OTA:
         print(f"[+] START 成功: {msg}")
         
         # 2. 发送 DATA
-        print("[*] 开始发送数据...")
-        offset = 0
+        print(f"[*] 开始发送数据 (窗口 {self.window})...")
         total_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-        current_chunk = 0
+        current_chunk = 0  # 已确认的块数
+        sent_chunks = 0    # 已发送的块数
+        # 热循环中绑定为局部变量, 省去每次属性查找
+        send_frame = self.send_frame
+        receive_ack = self.receive_ack
+        window = self.window
+        data_start = time.perf_counter()
         
-        while offset < file_size:
-            chunk = data[offset : offset + CHUNK_SIZE]
-            self.send_frame(OTA_CMD_DATA, chunk)
+        while current_chunk < total_chunks:
+            # 窗口未满时继续发送, 设备按顺序逐帧回复 ACK
+            while sent_chunks < total_chunks and sent_chunks - current_chunk < window:
+                start = sent_chunks * CHUNK_SIZE
+                send_frame(OTA_CMD_DATA, data[start : start + CHUNK_SIZE])
+                sent_chunks += 1
             
             # 每个包的 ACK 超时短一点
-            status, msg = self.receive_ack(timeout=1.0)
+            status, msg = receive_ack(timeout=1.0)
             if status != 0:
                 print(f"\n[-] 数据块 {current_chunk} 失败: {msg}")
                 return False
             
-            offset += len(chunk)
             current_chunk += 1
+            offset = min(current_chunk * CHUNK_SIZE, file_size)
             
             # 进度条
             percent = (offset * 100) // file_size
             bar_len = 40
             filled = (bar_len * percent) // 100
             bar = '█' * filled + '-' * (bar_len - filled)
-            sys.stdout.write(f"\r[{bar}] {percent}% ({offset}/{file_size})")
+            speed = offset / 1024 / max(time.perf_counter() - data_start, 1e-6)
+            sys.stdout.write(f"\r[{bar}] {percent}% ({offset}/{file_size}) {speed:.1f} KB/s")
             sys.stdout.flush()
             
-        print("\n[+] 数据发送完成")
+        elapsed = time.perf_counter() - data_start
+        print(f"\n[+] 数据发送完成, 用时 {elapsed:.2f} 秒")
         
         # 3. 发送 END
         print("[*] 发送 END 命令...")
-        self.send_frame(OTA_CMD_END)
+        self.send_frame(OTA_CMD_END, flush=True)
         # 结束操作可能耗时
         status, msg = self.receive_ack(timeout=5.0, verbose=True)
         
@@ -271,10 +370,11 @@ if __name__ == '__main__':
     parser.add_argument("--port", required=True, help="串口号 (如 COM3)")
     parser.add_argument("--file", required=True, help="固件 bin 文件路径")
     parser.add_argument("--baud", type=int, default=DEFAULT_BAUD, help="波特率")
+    parser.add_argument("--window", type=positive_int, default=1, help="同时在途的数据帧数 (1 为逐帧确认)")
     
     args = parser.parse_args()
     
-    ota = ESP32OTA(args.port, args.baud)
+    ota = ESP32OTA(args.port, args.baud, args.window)
     
     try:
         if ota.connect():